@@ -3,13 +3,27 @@
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import getpass
+import json
 import logging
-import traceback
 import os
+import re
 from enum import IntEnum
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-import click
+try:
+    import psycopg2
+    from psycopg2 import sql
+except ImportError:
+    # only the psql fallback is available
+    psycopg2 = None
 
 # By default, try "sudo" only when 'postgres' user exists
 DEFAULT_POSTGRES_UNIX_USER = 'postgres'
@@ -32,7 +46,25 @@ DEFAULT_DSN = {
     'user': DEFAULT_POSTGRES_SUPERUSER,
     'password': None,
     'database': 'template1',
+    'connect_timeout': 5,  # fail fast if the host is unreachable
 }
+if psycopg2 is not None and psycopg2.extensions.libpq_version() >= 120000:
+    # skip negotiation of GSSAPI encryption (saves a roundtrip per connection)
+    DEFAULT_DSN['gssencmode'] = 'disable'
+
+# File for caching the detected setup across processes (used by the command line tool)
+DEFAULT_SETUP_CACHE_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pgsu',
+    'setup.json')
+
+# Maximum number of connection attempts made concurrently when determining the setup
+MAX_PROBE_WORKERS = 3
+
+# Commands that cannot run inside a transaction block (and thus not in a batch with other commands)
+NO_TRANSACTION_REGEX = re.compile(
+    r'^\s*(CREATE\s+DATABASE|DROP\s+DATABASE|CREATE\s+TABLESPACE|DROP\s+TABLESPACE|ALTER\s+SYSTEM|VACUUM'
+    r'|(CREATE|ALTER|DROP)\s+SUBSCRIPTION|CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY|DROP\s+INDEX\s+CONCURRENTLY'
+    r'|REINDEX\b.*\bCONCURRENTLY)\b', re.IGNORECASE | re.DOTALL)
 
 LOGGER = logging.getLogger('pgsu')
 LOGGER.setLevel(logging.DEBUG)
@@ -46,11 +78,11 @@ class PostgresConnectionMode(IntEnum):
     PSQL = 2
 
 
-class PGSU:
+class PGSU:  # pylint: disable=too-many-instance-attributes
     """
     Connect to an existing PostgreSQL cluster as the `postgres` superuser and execute SQL commands.
 
-    Tries to use psycopg2 with a fallback to psql subcommands (using ``sudo su`` to run as postgres user).
+    Tries to use psycopg2 with a fallback to psql subcommands (using ``sudo -u`` to run as postgres user).
 
     Simple Example::
 
@@ -73,28 +105,36 @@ class PGSU:
                  dsn=None,
                  determine_setup=True,
                  try_sudo=DEFAULT_TRY_SUDO,
-                 postgres_unix_user=DEFAULT_POSTGRES_UNIX_USER):
+                 postgres_unix_user=DEFAULT_POSTGRES_UNIX_USER,
+                 setup_retry_delays=(),
+                 setup_cache_file=None):
         """Store postgres connection info.
 
         :param interactive: use True for verdi commands
         :param quiet: use False to show warnings/exceptions
         :param dsn: psycopg dictionary containing keys like 'host', 'user', 'port', 'database'.
             It is sufficient to provide only those values that deviate from the defaults.
-        :param determine_setup: Whether to determine setup upon instantiation.
+        :param determine_setup: Whether to determine setup automatically. The setup is determined lazily,
+            i.e. when first needed (e.g. by 'execute()'), so instantiation does not connect to PostgreSQL.
             You may set this to False and use the 'determine_setup()' method instead.
         :param try_sudo: If connection via psycopg2 fails, whether to try and use `sudo` to  become
             the `postgres_unix_user` and run commands using passwordless `psql`.
         :param postgres_unix_user: UNIX user to try to "become", if connection via psycopg2 fails
+        :param setup_retry_delays: Delays (in seconds) before retrying to connect via psycopg2 when determining the
+            setup, e.g. to wait for a server that is (re)starting. By default, no retries are made.
+        :param setup_cache_file: If set to a file path, the detected setup is cached there and reused by later
+            instances (see DEFAULT_SETUP_CACHE_FILE). Passwords are never written to the file.
         """
         self.interactive = interactive
         if not quiet:
             handler = logging.StreamHandler()
             handler.setLevel(logging.INFO)
             LOGGER.addHandler(handler)
-        self.connection_mode = PostgresConnectionMode.DISCONNECTED
+        self._connection_mode = PostgresConnectionMode.DISCONNECTED
 
         self.setup_fail_counter = 0
         self.setup_max_tries = 1
+        self.setup_retry_delays = setup_retry_delays
 
         self.dsn = DEFAULT_DSN.copy()
         if dsn is not None:
@@ -103,22 +143,51 @@ class PGSU:
         self.try_sudo = try_sudo
         self.postgres_unix_user = postgres_unix_user
 
-        if determine_setup:
-            self.determine_setup()
+        self.setup_cache_file = setup_cache_file
+
+        # psycopg2 connection for self.dsn and cursor on it, reused across execute() calls
+        self._conn = None
+        self._cursor = None
+        # statements prepared on self._conn (name -> command)
+        self._prepared = {}
+        # serializes use of the connection & cursor above, so that PGSU can be shared between threads
+        self._lock = threading.RLock()
 
-    def execute(self, command, **kwargs):
+        # setup is determined on first use, see _ensure_setup()
+        self._setup_pending = determine_setup
+
+    def execute(self, command, params=None, name=None, **kwargs):
         """Execute postgres command using determined connection mode.
 
         :param command: A psql command line as a str
+        :param params: Parameters to bind to the placeholders in the command (only supported via psycopg2).
+            Use ``%s`` placeholders, or ``$1``, ``$2``, ... when preparing the command via ``name``.
+        :param name: If provided, the command is prepared as server-side statement of this name on first use,
+            and subsequent calls with the same name execute the prepared statement (only supported via psycopg2).
+            If the name is reused for a different command, the statement is prepared anew.
+            Note: PostgreSQL can prepare only SELECT, INSERT, UPDATE, DELETE and VALUES statements.
         :param kwargs: will be forwarded to _execute_... function
         """
-        # Use self.dsn as default kwargs, update with provided dsn
-        dsn = self.dsn.copy()
-        dsn.update(kwargs)
+        self._ensure_setup()
+
+        # Use self.dsn as default kwargs, update with provided dsn.
+        # Note: dsn is not modified downstream, so self.dsn need not be copied if there is nothing to update
+        dsn = {**self.dsn, **kwargs} if kwargs else self.dsn
 
         if self.connection_mode == PostgresConnectionMode.PSYCOPG:
-            return _execute_psyco(command, dsn)
+            if kwargs:
+                if name is not None:
+                    raise ValueError(
+                        'Prepared statements are not supported when overriding connection parameters.'
+                    )
+                # connection parameters were overridden: use a one-off connection
+                return _execute_psyco(command, dsn, params=params)
+            return self._execute_psyco(command, params=params, name=name)
         if self.connection_mode == PostgresConnectionMode.PSQL:
+            if params is not None or name is not None:
+                raise ValueError(
+                    'Query parameters and prepared statements are only supported when connecting via psycopg2.'
+                )
             return _execute_su_psql(command, dsn)
 
         raise ConnectionError(
@@ -126,6 +195,119 @@ class PGSU:
                 dsn) +
             'Consider providing connection parameters via PGSU(dsn={...}).')
 
+    def execute_many(self, commands, **kwargs):
+        """Execute several postgres commands in as few roundtrips as possible.
+
+        Meant for commands that do not return results, such as CREATE/DROP/GRANT.
+
+        Consecutive commands are sent as a single query, which PostgreSQL runs in an implicit transaction,
+        i.e. either all or none of them take effect.
+        Commands that cannot run inside a transaction block (e.g. CREATE DATABASE, see ``NO_TRANSACTION_REGEX``)
+        are sent on their own.
+        The batches are executed in order and stop at the first error; batches executed before remain in effect.
+        Via psql, all batches are executed by a single psql process.
+
+        :param commands: iterable of psql command lines as str
+        :param kwargs: will be forwarded to _execute_... function
+        """
+        batches = _batch_commands(commands)
+        if not batches:
+            # Note: psql without any command would start an interactive session
+            return
+
+        self._ensure_setup()
+
+        if self._connection_mode == PostgresConnectionMode.PSQL:
+            dsn = {**self.dsn, **kwargs} if kwargs else self.dsn
+            _execute_su_psql(batches, dsn, fetch=False)
+            return
+
+        # if no connection could be established, execute() raises a ConnectionError
+        for batch in batches:
+            self.execute(batch, **kwargs)
+
+    def _execute_psyco(self, command, params=None, name=None):
+        """Execute postgres command over the cached psycopg2 connection.
+
+        If the connection has been lost (e.g. because the server was restarted), reconnect and retry once.
+
+        :param command: A psql command line as a str
+        :param params: Parameters to bind to the placeholders in the command
+        :param name: Name of the prepared statement (see ``execute()``)
+        """
+        with self._lock:
+            try:
+                return self._execute_on_connection(command, params, name)
+            except psycopg2.OperationalError:
+                # only retry if a previously open connection was lost (not if connecting failed)
+                if self._conn is None or not self._conn.closed:
+                    raise
+                LOGGER.debug('Lost connection to PostgreSQL, reconnecting...')
+            return self._execute_on_connection(command, params, name)
+
+    def _execute_on_connection(self, command, params, name):
+        """Execute postgres command over the cached psycopg2 connection, preparing it first if needed."""
+        cursor = self._get_cursor()
+        if name is not None:
+            identifier = sql.Identifier(name)
+            prepared_command = self._prepared.get(name)
+            if prepared_command != command:
+                if prepared_command is not None:
+                    # the name is reused for a different command
+                    _execute_psyco(sql.SQL('DEALLOCATE {}').format(identifier),
+                                   self.dsn,
+                                   cursor=cursor)
+                _execute_psyco(sql.SQL('PREPARE {} AS ').format(identifier) +
+                               sql.SQL(command),
+                               self.dsn,
+                               cursor=cursor)
+                self._prepared[name] = command
+            placeholders = ', '.join(['%s'] * len(params or ()))
+            command = sql.SQL('EXECUTE {}').format(identifier)
+            if placeholders:
+                command += sql.SQL(f'({placeholders})')
+        return _execute_psyco(command, self.dsn, cursor=cursor, params=params)
+
+    def _get_connection(self):
+        """Return psycopg2 connection for ``self.dsn``, opening it if necessary.
+
+        The connection is kept open in order to avoid the cost of connecting & authenticating on every call.
+        """
+        if self._conn is None or self._conn.closed:
+            self._conn = _connect_psycopg(self.dsn)
+            self._cursor = None
+            self._prepared = {}
+        return self._conn
+
+    def _get_cursor(self):
+        """Return cursor on the cached psycopg2 connection, creating it if necessary.
+
+        Since the connection is in autocommit mode and results are fetched right away, the cursor can be reused.
+        """
+        conn = self._get_connection()
+        if self._cursor is None or self._cursor.closed:
+            self._cursor = conn.cursor()
+        return self._cursor
+
+    def close(self):
+        """Close the connection to the PostgreSQL cluster, if open.
+
+        A new connection is opened automatically on the next call to ``execute()``.
+        """
+        with self._lock:
+            if self._conn is not None:
+                # closing the connection closes its cursor as well
+                self._conn.close()
+                self._conn = None
+                self._cursor = None
+                self._prepared = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
     def determine_setup(self):
         """Determine how to connect as the postgres superuser.
 
@@ -138,58 +320,234 @@ class PGSU:
         :returns success: True, if connection could be established.
         :rtype success: bool
         """
-        dsn = self.dsn.copy()
+        # hold the lock, so that other threads do not use the connection while the setup is being changed
+        with self._lock:
+            return self._determine_setup(requested_dsn=self.dsn.copy())
+
+    def _determine_setup(self, requested_dsn):
+        """Determine how to connect as the postgres superuser (see ``determine_setup``).
+
+        :param requested_dsn: dsn originally requested (i.e. before prompting for connection details),
+            under which the detected setup is cached
+        """
+        self._setup_pending = False
+        self.close()
+
+        if self._try_cached_setup():
+            return True
+
+        # The psql fallback spawns subprocesses (sudo may even ask for a password), so try it only if needed.
+        if self._try_psycopg() or self._try_psql_mode():
+            self._cache_setup(requested_dsn)
+            return True
+
+        return self._no_setup_detected(requested_dsn)
+
+    def _try_cached_setup(self):
+        """Try to connect using the setup cached for ``self.dsn`` in the ``setup_cache_file``, if any.
+
+        :returns: True, if connection could be established.
+        """
+        if self.setup_cache_file is None:
+            return False
+
+        entry = _read_setup_cache(self.setup_cache_file).get(
+            _setup_cache_key(self.dsn))
+        if entry is None:
+            return False
+
+        try:
+            # the password is not cached - it is the one requested
+            dsn = dict(entry['dsn'], password=self.dsn.get('password'))
+            mode = PostgresConnectionMode(entry['mode'])
+        except (KeyError, TypeError, ValueError):
+            LOGGER.debug('Ignoring invalid entry in setup cache %s',
+                         self.setup_cache_file)
+            return False
+
+        LOGGER.debug('Trying cached setup from %s...', self.setup_cache_file)
+        if mode == PostgresConnectionMode.PSYCOPG and psycopg2 is not None:
+            conn = _try_connect_psycopg(**dsn)
+            if conn is not None:
+                return self._use_probe_connection(conn, dsn)
+        elif mode == PostgresConnectionMode.PSQL and self.try_sudo:
+            if _try_su_psql(interactive=self.interactive, dsn=dsn):
+                self.dsn = dsn
+                self._connection_mode = PostgresConnectionMode.PSQL
+                return True
+
+        LOGGER.debug('Cached setup is no longer valid')
+        return False
+
+    def _cache_setup(self, requested_dsn):
+        """Store the detected setup for ``requested_dsn`` in the ``setup_cache_file``, if set.
+
+        :param requested_dsn: the dsn the setup was determined for
+        """
+        if self.setup_cache_file is None:
+            return
+
+        cache = _read_setup_cache(self.setup_cache_file)
+        cache[_setup_cache_key(requested_dsn)] = {
+            'dsn': {
+                key: value
+                for key, value in self.dsn.items() if key != 'password'
+            },
+            'mode': int(self._connection_mode),
+        }
+        _write_setup_cache(self.setup_cache_file, cache)
+
+    def _try_psycopg(self):
+        """Try to connect as a postgres superuser via psycopg2 (equivalent to using psql).
+
+        Retries after each of the ``setup_retry_delays``.
+
+        :returns: True, if connection could be established.
+        """
+        if psycopg2 is None:
+            LOGGER.debug('Skipping connection via "psycopg2" (not installed)')
+            return False
 
-        # Try to connect as a postgres superuser via psycopg2 (equivalent to using psql).
         LOGGER.debug('Trying to connect via "psycopg2"...')
-        for pg_user in unique_list([self.dsn.get('user'), None]):
-            dsn['user'] = pg_user
+        if self._try_psycopg_modes():
+            return True
+        for delay in self.setup_retry_delays:
+            LOGGER.info(
+                'Unable to connect via "psycopg2", retrying in %s s...', delay)
+            time.sleep(delay)
+            if self._try_psycopg_modes():
+                return True
+        return False
+
+    def _try_psql_mode(self):
+        """Try to connect by running psql as the ``postgres_unix_user`` via sudo.
+
+        Ubuntu uses setting 'peer' for 'local', i.e. we need to be UNIX user 'postgres' in order to connect as
+        database user 'postgres'.
+
+        :returns: True, if connection could be established.
+        """
+        if not self.try_sudo:
+            return False
+
+        LOGGER.debug('Trying to connect by becoming the "%s" unix user...',
+                     self.postgres_unix_user)
+        if not _sudo_exists():
+            LOGGER.info(
+                'Could not find `sudo` to become the the "%s" unix user.',
+                self.postgres_unix_user)
+            return False
+
+        dsn = self.dsn.copy()
+        dsn['user'] = self.postgres_unix_user
+        if not _try_su_psql(interactive=self.interactive, dsn=dsn):
+            return False
+
+        self.dsn = dsn
+        self._connection_mode = PostgresConnectionMode.PSQL
+        return True
+
+    def _try_psycopg_modes(self):
+        """Try to connect via psycopg2, using the configured and default users and hosts.
+
+        :returns: True, if connection could be established.
+        """
+        pg_users = [self.dsn.get('user')]
+        # Without user, libpq connects as the default user - no need to try if that is the user specified.
+        if _libpq_default_user() != self.dsn.get('user'):
+            pg_users.append(None)
+
+        candidates = []
+        for pg_user in unique_list(pg_users):
             # First try the host specified (works if 'host' has setting 'trust' in pg_hba.conf).
             # Then try local connection (works if 'local' has setting 'trust' in pg_hba.conf).
             # Then try 'host' localhost via TCP/IP.
             for pg_host in unique_list([self.dsn.get('host'), None, 'localhost']):   # yapf: disable
-                dsn['host'] = pg_host
-
-                if _try_connect_psycopg(**dsn):
-                    self.dsn = dsn
-                    self.connection_mode = PostgresConnectionMode.PSYCOPG
-                    return True
-
-        # Ubuntu uses setting 'peer' for 'local', i.e. we need to be UNIX user 'postgres' in order to connect as
-        # database user 'postgres'.
-        # Check if 'sudo' is available and try to become 'postgres'.
-        if self.try_sudo:
-            LOGGER.debug('Trying to connect by becoming the "%s" unix user...',
-                         self.postgres_unix_user)
-            if _sudo_exists():
-                dsn = self.dsn.copy()
-                dsn['user'] = self.postgres_unix_user
-
-                if _try_su_psql(interactive=self.interactive, dsn=dsn):
-                    self.dsn = dsn
-                    self.connection_mode = PostgresConnectionMode.PSQL
-                    return True
-            else:
-                LOGGER.info(
-                    'Could not find `sudo` to become the the "%s" unix user.',
-                    self.postgres_unix_user)
+                candidates.append(dict(self.dsn, user=pg_user, host=pg_host))
+
+        # Try the candidate of highest priority on its own first, which succeeds in most setups.
+        # This avoids opening connections (and causing failed authentication attempts) that are not needed.
+        conn = _try_connect_psycopg(**candidates[0])
+        if conn is not None:
+            return self._use_probe_connection(conn, candidates[0])
+        candidates = candidates[1:]
+        if not candidates:
+            return False
+
+        # Probe the remaining candidates concurrently (libpq releases the GIL while connecting),
+        # but pick the first successful one in the order above.
+        # Note: Probes of lower priority may still finish in the background (their connections are closed).
+        executor = ThreadPoolExecutor(
+            max_workers=min(len(candidates), MAX_PROBE_WORKERS))
+        futures = [
+            executor.submit(_try_connect_psycopg, **dsn) for dsn in candidates
+        ]
+        executor.shutdown(wait=False)
+
+        for index, future in enumerate(futures):
+            conn = future.result()
+            if conn is not None:
+                # connections of the remaining candidates are not needed
+                for other in futures[index + 1:]:
+                    if not other.cancel():
+                        other.add_done_callback(_close_probe_connection)
+                return self._use_probe_connection(conn, candidates[index])
 
-        self.setup_fail_counter += 1
-        return self._no_setup_detected()
+        return False
+
+    def _use_probe_connection(self, conn, dsn):
+        """Connect via psycopg2, keeping the probe connection open for subsequent execute() calls.
 
-    def _no_setup_detected(self):
+        :returns: True
+        """
+        self._conn = conn
+        self.dsn = dsn
+        self._connection_mode = PostgresConnectionMode.PSYCOPG
+        return True
+
+    def _no_setup_detected(self, requested_dsn):
         """Print a warning message and calls the failed setup callback
 
+        :param requested_dsn: dsn originally requested (see ``_determine_setup``)
         :returns: False, if no successful try.
         """
+        self.setup_fail_counter += 1
         LOGGER.warning('Unable to autodetect postgres setup.')
 
         if self.interactive and self.setup_fail_counter <= self.setup_max_tries:
-            self.dsn = prompt_for_dsn(self.dsn)
-            return self.determine_setup()
+            if sys.stdin is None or not sys.stdin.isatty():
+                # e.g. in CI or background jobs, where waiting for input would hang (stdin is None if closed)
+                LOGGER.warning(
+                    'Not prompting for connection details since stdin is not a terminal.'
+                )
+                return False
+            self.dsn.update(prompt_for_dsn(self.dsn))
+            return self._determine_setup(requested_dsn)
 
         return False
 
+    def _ensure_setup(self):
+        """Determine setup, if this is still pending."""
+        with self._lock:
+            if self._setup_pending:
+                self.determine_setup()
+
+    @property
+    def connection_mode(self):
+        """Mode of connecting to the PostgreSQL cluster (determines setup, if still pending).
+
+        :rtype: PostgresConnectionMode
+        """
+        self._ensure_setup()
+        return self._connection_mode
+
+    @connection_mode.setter
+    def connection_mode(self, mode):
+        """Set mode of connecting to the PostgreSQL cluster (skips determining the setup, if still pending)."""
+        with self._lock:
+            self._setup_pending = False
+            self._connection_mode = mode
+
     @property
     def is_connected(self):
         """Whether successful way of connecting to PostgreSQL cluster has been determined.
@@ -204,6 +562,9 @@ def prompt_for_dsn(dsn):
 
     :return: dictionary with the keys: host, port, database, user, password
     """
+    # click is only needed when prompting, which is rare - avoid its import cost otherwise
+    import click  # pylint: disable=import-outside-toplevel
+
     click.echo('Please provide PostgreSQL connection info:')
 
     # Note: Using '' as the prompt default is necessary to allow users to leave the field empty.
@@ -226,46 +587,177 @@ def prompt_for_dsn(dsn):
     return dsn_new
 
 
+def _batch_commands(commands):
+    """
+    Join consecutive commands into batches that can be sent as a single query.
+
+    Commands that cannot run inside a transaction block (see ``NO_TRANSACTION_REGEX``) form batches of their own.
+
+    :param commands: iterable of psql command lines as str
+    :return: list of batches as str
+    """
+    batches = []
+    batch = []
+    for command in commands:
+        if NO_TRANSACTION_REGEX.match(command):
+            if batch:
+                batches.append(';\n'.join(batch))
+                batch = []
+            batches.append(command)
+        else:
+            batch.append(command)
+    if batch:
+        batches.append(';\n'.join(batch))
+    return batches
+
+
+def _libpq_default_user():
+    """
+    Return the database user that libpq connects as, if no user is specified.
+
+    :return: $PGUSER or name of the current OS user, or None if it cannot be determined
+    """
+    return os.environ.get('PGUSER') or _current_user()
+
+
+@functools.lru_cache(maxsize=1)
+def _current_user():
+    """
+    Return name of the current OS user (cached, since it does not change during the lifetime of the process).
+
+    :return: user name, or None if it cannot be determined
+    """
+    try:
+        return getpass.getuser()
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def _setup_cache_key(dsn):
+    """
+    Return key of the setup cache entry for the given dsn (ignoring the password).
+    """
+    return json.dumps(
+        {key: value
+         for key, value in dsn.items() if key != 'password'},
+        sort_keys=True)
+
+
+def _read_setup_cache(path):
+    """
+    Read the setup cache file.
+
+    :return: dictionary with the cached setups (empty, if the file does not exist or cannot be read)
+    """
+    try:
+        with open(path, encoding='utf-8') as handle:
+            cache = json.load(handle)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        LOGGER.debug('Unable to read setup cache %s', path, exc_info=True)
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write_setup_cache(path, cache):
+    """
+    Write the setup cache file (readable only by the current user).
+
+    The file is replaced atomically, so concurrent processes never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # unique name (also across threads); the file is created with permissions 0600
+        with tempfile.NamedTemporaryFile('w',
+                                         dir=directory,
+                                         suffix='.tmp',
+                                         delete=False,
+                                         encoding='utf-8') as handle:
+            tmp_path = handle.name
+            json.dump(cache, handle)
+        os.replace(tmp_path, path)
+    except OSError:
+        LOGGER.debug('Unable to write setup cache %s', path, exc_info=True)
+
+
 def _try_connect_psycopg(**kwargs):
     """
     try to start a psycopg2 connection.
 
-    :return: True if successful, False otherwise
+    :return: the open connection if successful, None otherwise
     """
-    from psycopg2 import connect  # pylint: disable=import-outside-toplevel
-    success = False
+    conn = None
     try:
-        conn = connect(**kwargs)
-        success = True
-        conn.close()
+        conn = _connect_psycopg(kwargs)
     except Exception:  # pylint: disable=broad-except
-        LOGGER.debug('Unable to connect via psycopg')
-        LOGGER.debug(traceback.format_exc())
-    return success
+        # traceback is only formatted if a handler actually emits the record
+        LOGGER.debug('Unable to connect via psycopg', exc_info=True)
+    return conn
+
+
+def _close_probe_connection(future):
+    """
+    Close connection resulting from a ``_try_connect_psycopg`` call that is no longer needed.
+
+    :param future: future of the ``_try_connect_psycopg`` call
+    """
+    conn = future.result()
+    if conn is not None:
+        conn.close()
 
 
-def _execute_psyco(command, dsn):
+def _connect_psycopg(dsn):
+    """
+    Open a psycopg2 connection with autocommit enabled.
+
+    :param dsn: will be forwarded to psycopg2.connect
+    """
+    if dsn.get('host') == 'localhost' and not dsn.get('hostaddr'):
+        # Avoid the IPv6 attempt (and fallback to IPv4) when resolving 'localhost'.
+        # Note: 'host' is kept, since libpq matches it against ~/.pgpass entries (and uses it for SSL verification).
+        dsn = dict(dsn, hostaddr='127.0.0.1')
+    conn = psycopg2.connect(**dsn)
+    conn.autocommit = True
+    return conn
+
+
+def _execute_psyco(command, dsn, cursor=None, params=None):
     """
     executes a postgres commandline through psycopg2
 
     :param command: A psql command line as a str
     :param dsn: will be forwarded to psycopg2.connect
+    :param cursor: open psycopg2 cursor to use (of a connection with autocommit enabled).
+        If None, a new connection is opened and closed again afterwards.
+    :param params: parameters to bind to the placeholders in the command
     """
-    import psycopg2  # pylint: disable=import-outside-toplevel
-
-    conn = None
-    output = None
-    try:
-        conn = psycopg2.connect(**dsn)
-        conn.autocommit = True
-        with conn.cursor() as cursor:
-            cursor.execute(command)
-            if cursor.description is not None:
-                output = cursor.fetchall()
-    finally:
-        if conn:
+    if cursor is None:
+        conn = _connect_psycopg(dsn)
+        try:
+            with conn.cursor() as new_cursor:
+                return _execute_psyco(command,
+                                      dsn,
+                                      cursor=new_cursor,
+                                      params=params)
+        finally:
             conn.close()
-    return output
+
+    cursor.execute(command, params)
+    if cursor.description is not None:
+        return cursor.fetchall()
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def _sudo_path():
+    """
+    Look up the sudo command in the PATH (cached, since it does not change during the lifetime of the process).
+
+    :return: Full path to sudo, or None if not found
+    """
+    return shutil.which('sudo')
 
 
 def _sudo_exists():
@@ -274,14 +766,10 @@ def _sudo_exists():
 
     :return: True if successful, False otherwise
     """
-    try:
-        subprocess.check_output(['sudo', '-V'])
-        return True
-    except (subprocess.CalledProcessError, OSError):
-        LOGGER.debug('Failed to run "sudo" in a subprocess')
-        LOGGER.debug(traceback.format_exc())
-
-    return False
+    if _sudo_path() is None:
+        LOGGER.debug('Unable to find "sudo" in the PATH')
+        return False
+    return True
 
 
 def _try_su_psql(interactive, dsn):
@@ -291,43 +779,83 @@ def _try_su_psql(interactive, dsn):
     :return: True if successful, False otherwise
     """
     try:
-        _execute_su_psql(r'\q',
-                         interactive=interactive,
-                         dsn=dsn,
-                         stderr=subprocess.STDOUT)
+        # psql produces no output for '\q', so there is nothing to capture
+        sudo_psql = _su_psql_command(r'\q', dsn=dsn, interactive=interactive)
+        subprocess.check_call(sudo_psql,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
         return True
     except subprocess.CalledProcessError:
         LOGGER.debug('Failed to run "psql" in a subprocess as user %s',
-                     dsn.get('user'))
-        LOGGER.debug(traceback.format_exc())
+                     dsn.get('user'),
+                     exc_info=True)
     return False
 
 
-def _execute_su_psql(command, dsn, interactive=False, stderr=None):
+def _execute_su_psql(command, dsn, interactive=False, stderr=None, fetch=True):
     """
     Executes an SQL command via ``psql`` as another system user in a subprocess.
 
     Tries to "become" the user specified in ``dsn`` (i.e. interpreted as UNIX system user)
     and run psql in a subprocess.
 
-    :param command: A psql command line as a str
+    :param command: A psql command line as a str, or a list thereof (executed in order by the same psql process)
     :param dsn: connection details to forward to psql, signature as in psycopg2.connect
     :param interactive: If False, `sudo` won't ask for a password and fail if one is required.
     :param stderr: Allows redirection of stderr for subprocess call
+    :param fetch: If False, the output of psql is discarded (and None is returned)
     """
-    psql_option_str = ''
+    sudo_psql = _su_psql_command(command, dsn, interactive)
+    if not fetch:
+        subprocess.check_call(sudo_psql,
+                              stdout=subprocess.DEVNULL,
+                              stderr=stderr)
+        return None
+
+    # Process output line by line as it arrives, instead of buffering it as a whole
+    with subprocess.Popen(sudo_psql,
+                          stdout=subprocess.PIPE,
+                          stderr=stderr,
+                          encoding='utf-8') as process:
+        # with unaligned output, psql prints no padding or blank lines that would need to be removed
+        result = [line.rstrip('\n') for line in process.stdout]
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode,
+                                            sudo_psql,
+                                            output=os.linesep.join(result))
+    return result
+
+
+def _su_psql_command(command, dsn, interactive=False):
+    """
+    Build the command line for running ``psql`` as another system user (see ``_execute_su_psql``).
+
+    :param command: A psql command line as a str, or a list thereof
+    :param dsn: connection details to forward to psql, signature as in psycopg2.connect
+    :param interactive: If False, `sudo` won't ask for a password and fail if one is required.
+    :return: command line as list of arguments
+    """
+    psql_options = []
+
+    if isinstance(command, str):
+        commands = ['-c', command]
+    else:
+        # stop at the first failing command (psql would continue otherwise)
+        psql_options += ['-v', 'ON_ERROR_STOP=1']
+        commands = [arg for cmd in command for arg in ('-c', cmd)]
 
     database = dsn.get('database')
     if database:
-        psql_option_str += f'-d {database}'
+        psql_options += ['-d', database]
 
     # to do: Forward password to psql; ignore host only when the password is None.  # pylint: disable=fixme
     # Note: There is currently no known postgresql setup that needs this, though
     # password = dsn.get('password')
 
-    host = dsn.pop('host', 'localhost')
+    host = dsn.get('host')
     if host and host != 'localhost':
-        psql_option_str += f' -h {host}'
+        psql_options += ['-h', host]
     else:
         LOGGER.debug(
             "Found host 'localhost' but dropping '-h localhost' option for psql "
@@ -336,31 +864,25 @@ def _execute_su_psql(command, dsn, interactive=False, stderr=None):
 
     port = dsn.get('port')
     if port:
-        psql_option_str += f' -p {port}'
+        psql_options += ['-p', str(port)]
 
     # Note: This is *both* the UNIX user to become *and* the database user
     user = dsn.get('user')
 
-    # Build command line
-    sudo_cmd = ['sudo']
+    # Build command line.
+    # psql is executed directly (without going through `su` and a shell), so the command needs no escaping.
+    sudo_cmd = [_sudo_path() or 'sudo']
     if not interactive:
         sudo_cmd += ['-n']
-    su_cmd = ['su', user, '-c']
+    sudo_cmd += ['-u', user]
 
-    psql_cmd = [
-        'psql {opt} -tc {cmd}'.format(cmd=escape_for_bash(command),
-                                      opt=psql_option_str)
-    ]
-    sudo_su_psql = sudo_cmd + su_cmd + psql_cmd
+    # -t: print rows only, -A: unaligned output (no padding of values), --no-psqlrc: ignore user settings
+    psql_cmd = ['psql', '--no-psqlrc'] + psql_options + ['-t', '-A'] + commands
 
     LOGGER.info(
         "Trying to become '%s' user. You may be asked for your 'sudo' password.",
         user)
-    result = subprocess.check_output(sudo_su_psql, stderr=stderr)
-    result = result.decode('utf-8').strip().split(os.linesep)
-    result = [i for i in result if i]
-
-    return result
+    return sudo_cmd + psql_cmd
 
 
 def escape_for_bash(str_to_escape):
@@ -4,7 +4,7 @@
 """
 import pprint
 import click
-from . import PGSU
+from . import PGSU, DEFAULT_SETUP_CACHE_FILE
 
 GET_DBS_COMMAND = 'SELECT datname FROM pg_database'
 
@@ -13,7 +13,10 @@ GET_DBS_COMMAND = 'SELECT datname FROM pg_database'
 @click.argument('query', type=str, default=GET_DBS_COMMAND)
 def run(query):
     """Execute SQL command as PostrgreSQL superuser."""
-    pgsu = PGSU(interactive=True, quiet=False)
+    # reuse the setup detected by previous invocations
+    pgsu = PGSU(interactive=True,
+                quiet=False,
+                setup_cache_file=DEFAULT_SETUP_CACHE_FILE)
     click.echo(f'Executing query: {query}')
     dbs = pgsu.execute(query)
     click.echo(pprint.pformat(dbs))
@@ -2,6 +2,9 @@
 """pytest fixtures and test constants"""
 import os
 import platform
+import uuid
+import psycopg2.extensions
+import psycopg2.pool
 import pytest
 from pgsu import PGSU
 
@@ -19,6 +22,8 @@ CREATE_DB_COMMAND = \
 """CREATE DATABASE "{{}}" OWNER "{{}}" ENCODING 'UTF8' LC_COLLATE='{loc}' LC_CTYPE='{loc}' TEMPLATE=template0"""\
     .format(loc=LOCALE)
 DROP_DB_COMMAND = 'DROP DATABASE "{}"'
+# terminates remaining connections to the database (PostgreSQL >= 13)
+DROP_DB_FORCE_COMMAND = 'DROP DATABASE "{}" WITH (FORCE)'
 COPY_DB_COMMAND = 'CREATE DATABASE "{}" WITH TEMPLATE "{}" OWNER "{}"'
 
 GRANT_PRIV_COMMAND = 'GRANT ALL PRIVILEGES ON DATABASE "{}" TO "{}"'
@@ -28,7 +33,14 @@ DEFAULT_PASSWORD = 'newpassword'  # noqa
 DEFAULT_DB = 'newdb'
 
 
-@pytest.fixture()
+def server_version_num(pgsu):  # pylint: disable=redefined-outer-name
+    """Return version of the PostgreSQL server as integer, e.g. 130004 for 13.4."""
+    row = pgsu.execute('SHOW server_version_num')[0]
+    # rows are tuples via psycopg2, but plain strings via psql
+    return int(row[0] if isinstance(row, tuple) else row)
+
+
+@pytest.fixture(scope='session')
 def dsn_from_env():
     """Read DSN from test environment variables.
 
@@ -51,37 +63,68 @@ def dsn_from_env():
     return {k: v for k, v in dsn.items() if v}
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def pgsu(dsn_from_env):  # pylint: disable=redefined-outer-name
-    """Return configured PGSU instance.
+    """Return configured PGSU instance (shared by all tests).
 
+    The connection to PostgreSQL is closed again after tests finish.
     """
-    return PGSU(dsn=dsn_from_env)
+    # Don't wait for WAL to be flushed to disk on commit (only affects the connections of this instance).
+    # Note: 'jit=off' is not set since the parameter does not exist before PostgreSQL 11.
+    dsn = dict(dsn_from_env, options='-c synchronous_commit=off')
+    with PGSU(dsn=dsn) as instance:
+        yield instance
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def user(pgsu):  # pylint: disable=redefined-outer-name
-    """Create a new user in the DB cluster.
+    """Create a new user in the DB cluster (shared by all tests).
 
+    The name is randomized, so that concurrent test sessions do not interfere.
     User is deleted again after tests finish.
     """
+    name = f'{DEFAULT_USER}_{uuid.uuid4().hex[:8]}'
     # if user already exists, fail (we don't want to cause trouble)
-    assert not pgsu.execute(USER_EXISTS_COMMAND.format(DEFAULT_USER))
+    assert not pgsu.execute(USER_EXISTS_COMMAND.format(name))
 
-    pgsu.execute(CREATE_USER_COMMAND.format(DEFAULT_USER, DEFAULT_PASSWORD))
-    yield DEFAULT_USER
-    pgsu.execute(DROP_USER_COMMAND.format(DEFAULT_USER))
+    pgsu.execute(CREATE_USER_COMMAND.format(name, DEFAULT_PASSWORD))
+    yield name
+    pgsu.execute(DROP_USER_COMMAND.format(name))
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def database(pgsu, user):  # pylint: disable=redefined-outer-name
-    """Create test database.
+    """Create test database (shared by all tests).
 
+    The name is randomized, so that concurrent test sessions do not interfere.
     The test DB is deleted again after tests finish.
     """
+    name = f'{DEFAULT_DB}_{uuid.uuid4().hex[:8]}'
     # if database already exists, fail (we don't want to cause trouble)
-    assert not pgsu.execute(DB_EXISTS_COMMAND.format(DEFAULT_DB))
+    assert not pgsu.execute(DB_EXISTS_COMMAND.format(name))
+
+    pgsu.execute(CREATE_DB_COMMAND.format(name, user))
+    yield name
+
+    if server_version_num(pgsu) >= 130000:
+        pgsu.execute(DROP_DB_FORCE_COMMAND.format(name))
+    else:
+        pgsu.execute(DROP_DB_COMMAND.format(name))
 
-    pgsu.execute(CREATE_DB_COMMAND.format(DEFAULT_DB, user))
-    yield DEFAULT_DB
-    pgsu.execute(DROP_DB_COMMAND.format(DEFAULT_DB))
+
+@pytest.fixture(scope='session')
+def user_pool(pgsu, user, database):  # pylint: disable=redefined-outer-name
+    """Pool of connections to the test database as the test user.
+
+    Connections are opened on demand and closed again after tests finish.
+    """
+    host = pgsu.dsn.get('host') or 'localhost'
+    dsn = psycopg2.extensions.make_dsn(host=host,
+                                       port=pgsu.dsn.get('port'),
+                                       user=user,
+                                       password=DEFAULT_PASSWORD,
+                                       database=database)
+    # pass the connection string, so it is not rebuilt from keyword arguments on every connect
+    pool = psycopg2.pool.ThreadedConnectionPool(0, 4, dsn)
+    yield pool
+    pool.closeall()
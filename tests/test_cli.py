@@ -4,9 +4,19 @@
 """
 import getpass
 from click.testing import CliRunner
+import pytest
+from pgsu import cli
 from pgsu.cli import run
 
 
+@pytest.fixture(autouse=True)
+def setup_cache_file(tmp_path, monkeypatch):
+    """Let the cli cache the setup in a temporary file instead of the user's cache directory."""
+    cache_file = str(tmp_path / 'setup.json')
+    monkeypatch.setattr(cli, 'DEFAULT_SETUP_CACHE_FILE', cache_file)
+    return cache_file
+
+
 def test_plain(pgsu):  # pylint: disable=unused-argument
     """Run cli without parameters.
 
@@ -16,10 +26,13 @@ def test_plain(pgsu):  # pylint: disable=unused-argument
     assert 'template1' in result.output
 
 
-def test_users(pgsu):  # pylint: disable=unused-argument
+def test_users(pgsu):
     """Ask for database users."""
     result = CliRunner().invoke(run, ['SELECT usename FROM pg_user'])
 
+    # the dsn is only updated with the detected setup once the setup has been determined
+    assert pgsu.is_connected
+
     specified_user = pgsu.dsn.get('user')
     if specified_user:
         assert specified_user in result.output, result.output
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Test determining the setup (with mocked connections).
+
+"""
+import threading
+
+from pgsu import PGSU, PostgresConnectionMode
+
+
+class FakeConnection:  # pylint: disable=too-few-public-methods
+    """Stand-in for a psycopg2 connection."""
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = False
+        self.closed_event = threading.Event()
+
+    def close(self):
+        """Close the connection."""
+        self.closed = True
+        self.closed_event.set()
+
+
+def test_probe_first_candidate(monkeypatch):
+    """Check that no other candidates are tried if the candidate of highest priority works."""
+    calls = []
+
+    def try_connect(**dsn):
+        calls.append(dsn)
+        return FakeConnection(dsn)
+
+    monkeypatch.setattr('pgsu._try_connect_psycopg', try_connect)
+    monkeypatch.setattr('pgsu._libpq_default_user', lambda: 'other')
+
+    pgsu = PGSU(dsn={'user': 'postgres'}, try_sudo=False)
+    assert pgsu.connection_mode == PostgresConnectionMode.PSYCOPG
+    assert len(calls) == 1
+
+
+def test_probe_priority(monkeypatch):
+    """Check that the candidate of higher priority wins, even if it connects last."""
+    lower_priority_connected = threading.Event()
+    connections = []
+
+    def try_connect(**dsn):
+        if dsn['user'] == 'postgres' and dsn['host'] == 'localhost':
+            # connect only after a candidate of lower priority connected
+            assert lower_priority_connected.wait(timeout=5)
+        elif dsn['user'] is not None or dsn['host'] is not None:
+            # includes the candidate of highest priority (user 'postgres', host None)
+            return None
+        conn = FakeConnection(dsn)
+        connections.append(conn)
+        if dsn['user'] is None:
+            lower_priority_connected.set()
+        return conn
+
+    monkeypatch.setattr('pgsu._try_connect_psycopg', try_connect)
+    monkeypatch.setattr('pgsu._libpq_default_user', lambda: 'other')
+
+    pgsu = PGSU(dsn={'user': 'postgres'}, try_sudo=False)
+    assert pgsu.connection_mode == PostgresConnectionMode.PSYCOPG
+    assert pgsu.dsn['user'] == 'postgres'
+    assert pgsu.dsn['host'] == 'localhost'
+
+    # connection of the lower priority candidate is closed (possibly in the background), the other one is kept
+    assert len(connections) == 2
+    lower, higher = connections[0], connections[1]
+    assert lower.dsn['user'] is None
+    assert lower.closed_event.wait(timeout=5)
+    assert not higher.closed
+
+
+def test_probe_fully_specified(monkeypatch):
+    """Check that fully specified connection parameters are tried on their own first."""
+    calls = []
+
+    def try_connect(**dsn):
+        calls.append(dsn)
+        return FakeConnection(dsn)
+
+    monkeypatch.setattr('pgsu._try_connect_psycopg', try_connect)
+
+    dsn = {'host': 'db.example.com', 'user': 'admin', 'password': 'secret'}
+    pgsu = PGSU(dsn=dsn, try_sudo=False)
+    assert pgsu.connection_mode == PostgresConnectionMode.PSYCOPG
+    assert len(calls) == 1
+    assert calls[0]['host'] == 'db.example.com'
+
+
+def test_setup_retry_delays(monkeypatch):
+    """Check that connecting via psycopg2 is retried after the configured delays."""
+    results = [False, True]
+    sleeps = []
+
+    def try_psycopg_modes(self):
+        if results.pop(0):
+            self._connection_mode = PostgresConnectionMode.PSYCOPG  # pylint: disable=protected-access
+            return True
+        return False
+
+    def try_psql_mode(self):
+        raise AssertionError('psql should not be tried')
+
+    monkeypatch.setattr(PGSU, '_try_psycopg_modes', try_psycopg_modes)
+    monkeypatch.setattr(PGSU, '_try_psql_mode', try_psql_mode)
+    monkeypatch.setattr('pgsu.time.sleep', sleeps.append)
+
+    pgsu = PGSU(setup_retry_delays=[0.5, 1, 2])
+    assert pgsu.connection_mode == PostgresConnectionMode.PSYCOPG
+    # connected at the first retry
+    assert sleeps == [0.5]
+    assert not results
+
+
+def test_no_prompt_without_stdin(monkeypatch):
+    """Check that no prompt is shown if there is no stdin (e.g. under pythonw or with stdin closed)."""
+    monkeypatch.setattr(PGSU, '_try_psycopg', lambda self: False)
+    monkeypatch.setattr(PGSU, '_try_psql_mode', lambda self: False)
+    monkeypatch.setattr('sys.stdin', None)
+
+    pgsu = PGSU(interactive=True)
+    assert not pgsu.is_connected
+
+
+def test_set_connection_mode(monkeypatch):
+    """Check that setting the connection mode skips determining the setup."""
+    def determine_setup(self):
+        raise AssertionError('setup should not be determined')
+
+    monkeypatch.setattr(PGSU, 'determine_setup', determine_setup)
+
+    pgsu = PGSU()
+    pgsu.connection_mode = PostgresConnectionMode.PSQL
+    assert pgsu.connection_mode == PostgresConnectionMode.PSQL
+    assert pgsu.is_connected
+
+
+def test_setup_cache_after_prompt(tmp_path, monkeypatch):
+    """Check that a setup found via the prompt is cached under the dsn originally requested."""
+    cache_file = str(tmp_path / 'setup.json')
+
+    def try_psycopg(self):
+        if self.dsn['port'] != 5432:
+            return False
+        return self._use_probe_connection(FakeConnection(self.dsn), self.dsn)  # pylint: disable=protected-access
+
+    monkeypatch.setattr(PGSU, '_try_psycopg', try_psycopg)
+    monkeypatch.setattr(PGSU, '_try_psql_mode', lambda self: False)
+    monkeypatch.setattr('pgsu.prompt_for_dsn', lambda dsn: {'port': 5432})
+    monkeypatch.setattr('sys.stdin.isatty', lambda: True)
+
+    pgsu = PGSU(dsn={'port': 1234},
+                interactive=True,
+                setup_cache_file=cache_file)
+    assert pgsu.is_connected
+
+    # the next instance uses the cached setup, without prompting again
+    def prompt_for_dsn(dsn):
+        raise AssertionError('should not prompt')
+
+    monkeypatch.setattr('pgsu.prompt_for_dsn', prompt_for_dsn)
+    monkeypatch.setattr('pgsu._try_connect_psycopg',
+                        lambda **dsn: FakeConnection(dsn))
+    monkeypatch.setattr(PGSU, '_try_psycopg', lambda self: False)
+
+    pgsu = PGSU(dsn={'port': 1234},
+                interactive=True,
+                setup_cache_file=cache_file)
+    assert pgsu.connection_mode == PostgresConnectionMode.PSYCOPG
+    assert pgsu.dsn['port'] == 5432
+
+
+def test_determine_setup_locked(monkeypatch):
+    """Check that determining the setup holds the lock (shared with execute)."""
+    lock_held = []
+
+    def try_psycopg(self):
+        # RLock cannot be acquired from another thread while it is held
+        thread = threading.Thread(target=lambda: lock_held.append(
+            not self._lock.acquire(blocking=False)))  # pylint: disable=protected-access
+        thread.start()
+        thread.join()
+        return False
+
+    monkeypatch.setattr(PGSU, '_try_psycopg', try_psycopg)
+    monkeypatch.setattr(PGSU, '_try_psql_mode', lambda self: False)
+
+    pgsu = PGSU(determine_setup=False)
+    assert not pgsu.determine_setup()
+    assert lock_held == [True]
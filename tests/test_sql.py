@@ -3,63 +3,214 @@
 
 Test creating/dropping users and databases.
 """
-import os
 import sys
-from contextlib import contextmanager
-from io import StringIO
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import click
 import psycopg2
+import pytest
 
-from pgsu import PGSU, DEFAULT_DSN
+from pgsu import PGSU, DEFAULT_DSN, PostgresConnectionMode, _batch_commands
 import conftest
 
 
-def test_create_drop_user(user):  # pylint: disable=unused-argument
-    """Create and drop user using fixture."""
+def test_fixtures_available(pgsu, user, database):
+    """Check that the user and database fixtures have been created."""
+    assert pgsu.execute(conftest.USER_EXISTS_COMMAND.format(user))
+    assert pgsu.execute(conftest.DB_EXISTS_COMMAND.format(database))
 
 
-def test_create_drop_db(user, database):  # pylint: disable=unused-argument
-    """Create and drop database + user using fixture."""
-
-
-def test_grant_priv(pgsu, user, database):  # pylint: disable=unused-argument
+def test_grant_priv(pgsu, user, database, user_pool):
     """Create new user + database and connect as that user."""
 
     # grant privileges
     pgsu.execute(conftest.GRANT_PRIV_COMMAND.format(database, user))
 
     # connect as new user
-    dsn = {
-        'host': pgsu.dsn.get('host') or 'localhost',
-        'port': pgsu.dsn.get('port'),
-        'user': user,
-        'password': conftest.DEFAULT_PASSWORD,
-        'database': database,
-    }
-    conn = psycopg2.connect(**dsn)
-    conn.close()
-
-
-@contextmanager
-def input_dsn(dsn):
-    """Enter PostgreSQL connection details via terminal.
-
-    See https://stackoverflow.com/a/36491341/1069467
-    """
-    inputs = []
-    for key in ['host', 'port', 'user', 'database', 'password']:
-        inputs.append(str(dsn.get(key, '')))
-
-    input_str = str(os.linesep.join(inputs) + os.linesep)
-    orig = sys.stdin
-    sys.stdin = StringIO(input_str)
-    yield
-    sys.stdin = orig
-
-
-def test_interactive(dsn_from_env):
+    conn = user_pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT current_user')
+            assert cursor.fetchone() == (user, )
+    finally:
+        user_pool.putconn(conn)
+
+
+def test_execute_many(pgsu):
+    """Create and drop user + database using a batch of commands."""
+    suffix = uuid.uuid4().hex[:8]
+    user = f'{conftest.DEFAULT_USER}_{suffix}'
+    database = f'{conftest.DEFAULT_DB}_{suffix}'
+    assert not pgsu.execute(conftest.USER_EXISTS_COMMAND.format(user))
+
+    try:
+        # commands may be any iterable (CREATE DATABASE is sent on its own)
+        pgsu.execute_many(cmd for cmd in [
+            conftest.CREATE_USER_COMMAND.format(user,
+                                                conftest.DEFAULT_PASSWORD),
+            conftest.CREATE_DB_COMMAND.format(database, user),
+        ])
+        assert pgsu.execute(conftest.DB_EXISTS_COMMAND.format(database))
+
+        pgsu.execute_many([
+            conftest.DROP_DB_COMMAND.format(database),
+            conftest.DROP_USER_COMMAND.format(user),
+        ])
+        assert not pgsu.execute(conftest.USER_EXISTS_COMMAND.format(user))
+    finally:
+        # clean up, in case the test failed halfway
+        if pgsu.execute(conftest.DB_EXISTS_COMMAND.format(database)):
+            pgsu.execute(conftest.DROP_DB_COMMAND.format(database))
+        if pgsu.execute(conftest.USER_EXISTS_COMMAND.format(user)):
+            pgsu.execute(conftest.DROP_USER_COMMAND.format(user))
+
+
+def test_batch_commands():
+    """Check that commands that cannot run in a transaction block are not batched with other commands."""
+    assert _batch_commands(iter(['GRANT a',
+                                 'GRANT b'])) == ['GRANT a;\nGRANT b']
+    assert _batch_commands([
+        'CREATE USER a', 'create  database a', 'GRANT a', 'REVOKE a',
+        'DROP DATABASE a'
+    ]) == [
+        'CREATE USER a', 'create  database a', 'GRANT a;\nREVOKE a',
+        'DROP DATABASE a'
+    ]
+
+
+def test_execute_many_edge_cases(monkeypatch):
+    """Check execute_many without commands and without connection."""
+    pgsu = PGSU(determine_setup=False)
+    # nothing to execute (in particular, no psql session is started)
+    assert pgsu.execute_many([]) is None
+
+    monkeypatch.setattr('pgsu.psycopg2', None)
+    with pytest.raises(ConnectionError):
+        pgsu.execute_many(cmd for cmd in ['SELECT 1', 'SELECT 2'])
+
+
+def test_connection_reuse(pgsu):
+    """Check that consecutive commands are executed over the same connection."""
+    if pgsu.connection_mode != PostgresConnectionMode.PSYCOPG:
+        pytest.skip('connections are only reused when connecting via psycopg2')
+
+    pid = pgsu.execute('SELECT pg_backend_pid()')
+    assert pgsu.execute('SELECT pg_backend_pid()') == pid
+
+    # after closing, a new connection is opened
+    pgsu.close()
+    assert pgsu.execute('SELECT pg_backend_pid()') != pid
+
+
+def test_reconnect(pgsu):
+    """Check that a lost connection is re-established transparently."""
+    if pgsu.connection_mode != PostgresConnectionMode.PSYCOPG:
+        pytest.skip('connections are only reused when connecting via psycopg2')
+
+    pid = pgsu.execute('SELECT pg_backend_pid()')[0][0]
+    # terminate the cached connection from a separate (one-off) connection
+    pgsu.execute(f'SELECT pg_terminate_backend({pid})',
+                 database=pgsu.dsn['database'])
+    assert pgsu.execute('SELECT pg_backend_pid()')[0][0] != pid
+
+
+def test_close_then_unreachable(monkeypatch):
+    """Check that failing to reconnect after close() raises the connection error."""
+    pgsu = PGSU()
+    pgsu.connection_mode = PostgresConnectionMode.PSYCOPG
+    pgsu.close()
+
+    def connect(**kwargs):
+        raise psycopg2.OperationalError('server is down')
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    with pytest.raises(psycopg2.OperationalError, match='server is down'):
+        pgsu.execute('SELECT 1')
+
+
+def test_threads(pgsu):
+    """Check that a PGSU instance can be shared between threads."""
+    if pgsu.connection_mode != PostgresConnectionMode.PSYCOPG:
+        pytest.skip('connections are only reused when connecting via psycopg2')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(lambda i: pgsu.execute(f'SELECT {i}'), range(20)))
+    assert results == [[(i, )] for i in range(20)]
+
+
+def test_params(pgsu):
+    """Check binding of parameters, with and without preparing the statement."""
+    if pgsu.connection_mode != PostgresConnectionMode.PSYCOPG:
+        pytest.skip(
+            'parameters are only supported when connecting via psycopg2')
+
+    assert pgsu.execute('SELECT datname FROM pg_database WHERE datname=%s',
+                        params=('template1', )) == [('template1', )]
+
+    query = 'SELECT datname FROM pg_database WHERE datname=$1'
+    for database in ['template1', 'template0']:
+        assert pgsu.execute(query, params=(database, ),
+                            name='pgsu_get_db') == [(database, )]
+
+    # statement is prepared again on the new connection
+    pgsu.close()
+    assert pgsu.execute(query, params=('template1', ),
+                        name='pgsu_get_db') == [('template1', )]
+
+    # reusing the name for a different command prepares the new command
+    assert pgsu.execute('SELECT $1::text || $1::text',
+                        params=('ab', ),
+                        name='pgsu_get_db') == [('abab', )]
+
+    # names are quoted
+    assert pgsu.execute('SELECT 1', name='pgsu "get"; one') == [(1, )]
+
+
+def test_setup_cache(dsn_from_env, tmp_path, monkeypatch):
+    """Check that the detected setup is cached and reused (without storing the password)."""
+    cache_file = str(tmp_path / 'pgsu' / 'setup.json')
+
+    with PGSU(dsn=dsn_from_env, setup_cache_file=cache_file) as pgsu:
+        assert pgsu.is_connected
+        mode = pgsu.connection_mode
+    with open(cache_file, encoding='utf-8') as handle:
+        assert 'password' not in handle.read()
+
+    # the cached setup is used without probing
+    monkeypatch.setattr(PGSU, '_try_psycopg', lambda self: False)
+    monkeypatch.setattr(PGSU, '_try_psql_mode', lambda self: False)
+    with PGSU(dsn=dsn_from_env, setup_cache_file=cache_file) as pgsu:
+        assert pgsu.connection_mode == mode
+        assert pgsu.execute(conftest.DB_EXISTS_COMMAND.format('template1'))
+
+
+def test_setup_cache_try_sudo(tmp_path, monkeypatch):
+    """Check that a cached psql setup is not used if trying sudo is disabled."""
+    cache_file = str(tmp_path / 'setup.json')
+    pgsu = PGSU(try_sudo=True, setup_cache_file=cache_file)
+    monkeypatch.setattr(PGSU, '_try_psycopg', lambda self: False)
+    monkeypatch.setattr('pgsu._sudo_exists', lambda: True)
+    monkeypatch.setattr('pgsu._try_su_psql', lambda interactive, dsn: True)
+    assert pgsu.connection_mode == PostgresConnectionMode.PSQL
+
+    pgsu = PGSU(try_sudo=False, setup_cache_file=cache_file)
+    assert pgsu.connection_mode == PostgresConnectionMode.DISCONNECTED
+
+
+def test_interactive(dsn_from_env, monkeypatch):
     """Test that connection details can be provided via prompt."""
-    dsn_from_env['port'] = DEFAULT_DSN['port']
-    with input_dsn(dsn_from_env):
-        PGSU(dsn={'port': 1234}, interactive=True,
-             quiet=False)  # provide wrong port
-        assert PGSU.is_connected
+    # Note: dsn_from_env is shared by all tests and must not be modified
+    dsn = dict(dsn_from_env, port=DEFAULT_DSN['port'])
+    answers = [
+        str(dsn.get(key, ''))
+        for key in ['host', 'port', 'user', 'database', 'password']
+    ]
+    # click binds the builtin input() at import time, so patch it where click looks it up
+    monkeypatch.setattr(click.termui, 'visible_prompt_func',
+                        lambda prompt: answers.pop(0))
+    monkeypatch.setattr(sys.stdin, 'isatty', lambda: True)
+
+    pgsu = PGSU(dsn={'port': 1234}, interactive=True,
+                quiet=False)  # provide wrong port
+    assert pgsu.is_connected